@@ -15,12 +15,131 @@ __version__ = '0.1'
 
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import logging
 import os
+import pathlib
 import re
-from requests_html import HTMLSession
+import sys
+import time
+from urllib.parse import urljoin
+import httpx
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 import zipfile
 
 
+log = logging.getLogger('webtoon-dl')
+
+# Number of comic page images downloaded at the same time
+PAGE_WORKERS = 10
+
+# Number of comic issues downloaded at the same time, each with up to PAGE_WORKERS pages
+ISSUE_WORKERS = 4
+
+# Number of gallery list pages downloaded at the same time
+LIST_WORKERS = 10
+
+# Capture groups: author -- Author name, title -- Comic title, number -- Issue number if present
+URL_RE = re.compile(r"webtoons\.com/.+?/.+?/(?P<author>.+?)/(?P<title>.+?)[?/](?:.*?[?&]episode_no=(?P<number>\d+))?")
+
+# CSS selectors for the parts of webtoons pages that are scraped
+SEL_LIST = CSSSelector('#_listUl')
+SEL_IMAGES = CSSSelector('._images')
+SEL_PAGINATE = CSSSelector('.paginate')
+SEL_NEXT = CSSSelector('.pg_next')
+
+# Browser user agent sent with every request
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/603.3.8 (KHTML, like Gecko) Version/10.1.2 Safari/603.3.8"
+
+# Retry requests answered with these statuses, waiting as long as the server's
+# Retry-After header asks (up to RETRY_AFTER_MAX seconds), or else RETRY_BACKOFF
+# seconds before the first retry and doubling the wait after each one
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_AFTER_MAX = 120
+
+
+class RetryTransport(httpx.HTTPTransport):
+    """
+    HTTP transport that also retries requests the server failed with a RETRY_STATUS,
+    on top of the connection retries done by httpx.HTTPTransport
+    """
+    
+    def handle_request(self, request):
+        for attempt in range(RETRIES):
+            response = super().handle_request(request)
+            
+            if response.status_code not in RETRY_STATUS:
+                return (response)
+            
+            response.close()
+            
+            try:
+                delay = min(int(response.headers.get('Retry-After')), RETRY_AFTER_MAX)
+            except (TypeError, ValueError):
+                delay = RETRY_BACKOFF * 2 ** attempt
+            
+            time.sleep(max(delay, 0))
+        
+        return (super().handle_request(request))
+
+
+# Single HTTP/2 client shared by every request so connections are kept alive and
+# reused, page images from the same host are multiplexed over one connection.
+# The pool still allows a connection for every page of every issue in flight
+# for hosts that only speak HTTP/1.1
+CLIENT = httpx.Client(headers={'User-Agent': USER_AGENT},
+                      follow_redirects=True,
+                      timeout=30,
+                      transport=RetryTransport(http2=True,
+                                               retries=RETRIES,
+                                               limits=httpx.Limits(max_connections=ISSUE_WORKERS * PAGE_WORKERS,
+                                                                   max_keepalive_connections=ISSUE_WORKERS * PAGE_WORKERS)))
+
+
+def parse_html(response):
+    """
+    Parse the body of an HTML response into an lxml document
+    :param response: httpx.Response for an HTML page
+    :return: lxml.html.HtmlElement root of the page
+    """
+    
+    return (lxml_html.fromstring(response.content, base_url=str(response.url)))
+
+
+def absolute_links(element):
+    """
+    Return all links inside an element, resolved against the page URL
+    :param element: lxml.html.HtmlElement parsed by parse_html
+    :return: set of str absolute URLs, skipping anchors and javascript links
+    """
+    
+    return ({urljoin(element.base_url, href) for href in element.xpath('.//a/@href')
+             if href and not href.startswith(('#', 'javascript:', 'mailto:'))})
+
+
+def get_list_page(url):
+    """
+    Download and parse one page of a gallery list
+    :param url: str URL to gallery list page
+    :return: lxml.html.HtmlElement root of the page, None if it failed to download
+    """
+    
+    try:
+        r = CLIENT.get(url)
+    except httpx.HTTPError as e:
+        # Timeouts and connection errors count as a failed page, same as an error status
+        log.warning("Gallery page %s failed: %s", url, e)
+        return
+    
+    if r.is_success:
+        return (parse_html(r))
+
+
 def comics_from_gallery(gallery_url):
     """
     Return a list of comic issue URLs from a gallery URL
@@ -29,25 +148,54 @@ def comics_from_gallery(gallery_url):
     """
 
     comics_list = []
-    pages = []
     
-    session = HTMLSession()
+    # Parsed list pages keyed by URL so each one is only requested once,
+    # None marks pages that failed to download
+    pages = {}
+    
+    # Start from first page
+    major_url = gallery_url
     
-    # Get first page
-    pages.append(session.get(gallery_url))
+    # First pages of groups already walked, stops the loop if a "next" link
+    # ever points back to an earlier group
+    major_urls = set()
     
-    if pages[0]:
-        # Extract list of other pages and download
-        for new_page in pages[0].html.find('.paginate', first=True).absolute_links:
-            # Get all other pages
-            pages.append(session.get(new_page))
+    # The paginator only links to a group of 10 pages at a time, with a
+    # "next" link to the first page of the following group
+    while major_url and major_url not in major_urls:
+        major_urls.add(major_url)
+        
+        if major_url not in pages:
+            pages[major_url] = get_list_page(major_url)
+        
+        document = pages[major_url]
+        
+        if document is None:
+            break
         
-        # Extract list of every comic on every page
-        for page in pages:
-            comics_list.extend(page.html.find('#_listUl', first=True).absolute_links)
-            # TODO: how does pagination work on webtoons? The div with class "paginate" on a gallery page seems to have equal entities to the number of pages. Is there an upper limit to this? Is it reliable?
-           
-    return (comics_list)
+        paginate = SEL_PAGINATE(document)
+        
+        if not paginate:
+            break
+        
+        # Get all other pages of this group at once, skipping ones already seen
+        page_links = [link for link in absolute_links(paginate[0]) if link not in pages]
+        
+        with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+            for link, page in zip(page_links, executor.map(get_list_page, page_links)):
+                pages[link] = page
+        
+        # Groups can only be discovered one after another
+        next_group = SEL_NEXT(paginate[0])
+        major_url = urljoin(document.base_url, next_group[0].get('href')) if next_group else None
+    
+    # Extract list of every comic on every page
+    for page in pages.values():
+        if page is not None:
+            comics_list.extend(absolute_links(SEL_LIST(page)[0]))
+    
+    # The same list page can be linked under different URLs, drop repeated comics
+    return (list(dict.fromkeys(comics_list)))
 
 
 def process_url_list(url_list):
@@ -55,28 +203,39 @@ def process_url_list(url_list):
     Organize webtoons URLs into dictionary and expand any links to galleries
     :param url_list: list of str URLs to comic issue or gallery pages
     :return: list of dicts containing url, author and title for each comic issue
-             [{'url': str, 'author': str, 'title': str}, ...]
+             [{'url': str, 'author': str, 'title': str, 'number': int or None}, ...]
     """
     
     processed_list = []
     
-    for url in url_list:
-        # Capture groups: 0 -- Full match, 1 -- Author name, 2 -- Comic title
-        r = re.search(r"webtoons\.com\/.+?\/.+?\/(.+?)\/(.+?)(?:\?|\/)", url)
+    # URLs still to look at, galleries add their issues to the end
+    queue = deque(url_list)
+    visited = set()
+    
+    while queue:
+        url = queue.popleft()
+        
+        # Same issue or gallery may be given more than once
+        if url in visited:
+            continue
+        
+        visited.add(url)
+        r = URL_RE.search(url)
         
         if r:
             # Check if webtoon_url is gallery
-            if r.group(2) == "list":
-                print("Getting gallery from %s..." % r.group(1))
+            if r['title'] == "list":
+                log.info("Getting gallery from %s...", r['author'])
                 
-                # Do additional processing that returns new url list
-                # Recursivly run this fuction
-                # Extend results into expanded_list
-                processed_list.extend(process_url_list(comics_from_gallery(url)))
+                # Queue up every issue in gallery
+                queue.extend(comics_from_gallery(url))
                 
             else:
-                processed_list.append({'url': url, 'author': r.group(1), 'title': r.group(2)})
-                print(r.group(2))
+                processed_list.append({'url': url,
+                                       'author': r['author'],
+                                       'title': r['title'],
+                                       'number': int(r['number']) if r['number'] else None})
+                log.info(r['title'])
 
     return (processed_list)
 
@@ -85,44 +244,161 @@ def get_comic_pages(issue_dict):
     """
     Get direct image links to all comic page images from link to issue page
     :param issue_dict: comic issue dict entry
-                       {'url': str, 'author': str, 'title': str}
+                       {'url': str, 'author': str, 'title': str, 'number': int or None}
     :return: list of str URLs to comic page images
     """
     
-    session = HTMLSession()
+    pages_list = []
     
-    r = session.get(issue_dict['url'])
+    try:
+        r = CLIENT.get(issue_dict['url'])
+    except httpx.HTTPError as e:
+        log.warning("Issue %s: could not get page list: %s", issue_dict['title'], e)
+        return (pages_list)
     
-    if r:
-        pages_list = [page.attrs['data-url'] for page in r.html.find('._images')]
-        print("Comic %s: got %i pages" % (issue_dict['title'], len(pages_list)))
+    if r.is_success:
+        pages_list = [page.get('data-url') for page in SEL_IMAGES(parse_html(r))]
+        log.info("Comic %s: got %i pages", issue_dict['title'], len(pages_list))
     return (pages_list)
 
 
 
-def get_comic_page_images(issue_dict):
+def get_comic_page_images(issue_dict, indexes=None):
     """
     Get image files for each page of comic issue
     :param issue_dict: comic issue dict entry
-                       {'url': str, 'author': str, 'title': str}
-    :return: list of jpg binary data for each page of comic
+                       {'url': str, 'author': str, 'title': str, 'number': int or None}
+    :param indexes: iterable of int page indexes to download, defaults to every page
+    :return: generator of (int page index, jpg binary data) in page order,
+             pages that failed to download are skipped
     """
     
-    page_images = []
+    log.debug("Issue: %s", issue_dict['title'])
     
-    session = HTMLSession()
+    def fetch_page(index):
+        log.debug("Downloading page %i/%i of %s", (index + 1), len(issue_dict['page-urls']), issue_dict['title'])
+        try:
+            r = CLIENT.get(issue_dict['page-urls'][index], headers={'referer': issue_dict['url']})
+        except httpx.HTTPError as e:
+            # Timeouts and connection errors count as a failed page, same as an error status
+            log.warning("Issue %s: page %i failed: %s", issue_dict['title'], (index + 1), e)
+            return
+        
+        if r.is_success:
+            return (r.content)
     
-    print("Issue: %s" % issue_dict['title'])
+    indexes = iter(range(len(issue_dict['page-urls'])) if indexes is None else indexes)
     
-    # Download each image in page list and create list of jpg binary data
-    for index, page in enumerate(issue_dict['page-urls']):
-        print("Downloading page %i/%i" % ((index + 1), len(issue_dict['page-urls'])))
-        r = session.get(page, headers={'referer': issue_dict['url']})
+    # Download pages concurrently but only keep PAGE_WORKERS of them in memory,
+    # each page is handed to the caller as soon as the pages before it are done
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        pending = deque((index, executor.submit(fetch_page, index))
+                        for index in islice(indexes, PAGE_WORKERS))
         
-        if r:
-            page_images.append(r.content)
+        while pending:
+            index, future = pending.popleft()
+            image = future.result()
+            
+            # Start on the next page before handing this one over
+            for next_index in islice(indexes, 1):
+                pending.append((next_index, executor.submit(fetch_page, next_index)))
+            
+            if image is not None:
+                yield (index, image)
 
-    return (page_images)
+
+def save_comic(issue_dict, args):
+    """
+    Download comic issue and save it as a CBZ archive or a folder of images
+    :param issue_dict: comic issue dict entry
+                       {'url': str, 'author': str, 'title': str, 'number': int or None}
+    :param args: parsed command line arguments
+    """
+    
+    if issue_dict['number'] is not None:
+        log.info("Saving issue %i: %s_%s...", issue_dict['number'], issue_dict['author'], issue_dict['title'])
+    else:
+        log.info("Saving issue %s_%s...", issue_dict['author'], issue_dict['title'])
+
+    # Create output directory
+    output = pathlib.Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    
+    name = "%s_%s" % (issue_dict['author'], issue_dict['title'])
+    
+    # Raw mode, save images into folders
+    if args.raw:
+        if args.number and issue_dict['number'] is not None:
+            outpath = output / ("%i_%s" % (issue_dict['number'], name))
+        else:
+            outpath = output / name
+        
+        # Add page URLs for issue
+        issue_dict['page-urls'] = get_comic_pages(issue_dict)
+        
+        if not issue_dict['page-urls']:
+            log.warning("Issue %s: no pages found, will retry on next run", issue_dict['title'])
+            return
+        
+        outpath.mkdir(exist_ok=True)
+        
+        # Only download pages left over from an earlier run
+        missing = [index for index in range(len(issue_dict['page-urls']))
+                   if not (outpath / ("%i.jpg" % index)).exists()]
+        
+        if not missing:
+            log.info("Issue %s already downloaded, skipping", issue_dict['title'])
+            return
+        
+        pages_written = 0
+        
+        # Write each image to folder as it is downloaded, renamed into place
+        # once complete so an interrupted write is not mistaken for a page
+        for index, image in get_comic_page_images(issue_dict, missing):
+            partpath = outpath / ("%i.jpg.part" % index)
+            partpath.write_bytes(image)
+            partpath.replace(outpath / ("%i.jpg" % index))
+            pages_written += 1
+        
+        # Pages that failed are still missing from the folder, so they are
+        # fetched again on the next run
+        if pages_written < len(missing):
+            log.warning("Issue %s: only got %i/%i missing pages, will retry on next run",
+                        issue_dict['title'], pages_written, len(missing))
+
+    # CBZ mode
+    else:
+        outpath = output / (name + ".cbz")
+        partpath = output / (name + ".cbz.part")
+        
+        if outpath.exists():
+            log.info("Issue %s already downloaded, skipping", issue_dict['title'])
+            return
+        
+        # Add page URLs for issue
+        issue_dict['page-urls'] = get_comic_pages(issue_dict)
+        
+        if not issue_dict['page-urls']:
+            log.warning("Issue %s: no pages found, will retry on next run", issue_dict['title'])
+            return
+        
+        pages_written = 0
+        
+        # Write each image into zip file as it is downloaded
+        # JPEGs are already compressed, deflating them again only costs CPU so store them as-is
+        with zipfile.ZipFile(partpath, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zip:
+            for index, image in get_comic_page_images(issue_dict):
+                zip.writestr("%i.jpg" % index, image)
+                pages_written += 1
+        
+        # The archive only gets its final name once every page is in it,
+        # otherwise it is dropped so the issue is retried on the next run
+        if pages_written == len(issue_dict['page-urls']):
+            partpath.replace(outpath)
+        else:
+            partpath.unlink()
+            log.warning("Issue %s: only got %i/%i pages, will retry on next run",
+                        issue_dict['title'], pages_written, len(issue_dict['page-urls']))
 
 
 
@@ -144,50 +420,24 @@ parser.add_argument("-o", "--output",
 parser.add_argument("-n", "--number",
                     help="Add episode/issue numbers to file names- useful when episodes/issue names do not contain numbering.",
                     action="store_true")
+parser.add_argument("-v", "--verbose",
+                    help="Show progress of every page download.",
+                    action="store_true")
 
 # Parse arguments
 args = parser.parse_args()
 
-print("Finding comics...")
-comic_list = process_url_list(args.webtoon_url)
-print("Found %i issues." % len(comic_list))
-
-# Add page URLs for each issue in dict list
-[comic.update({'page-urls': get_comic_pages(comic)}) for comic in comic_list]
-
-# Get images for each issue in dict list
-[comic.update({'page-img': get_comic_page_images(comic)}) for comic in comic_list]
-
-# Save each comic
-for comic in comic_list:
-    # Fetch the chapter/episode/issue number from the end of the URL
-    episodeNumber = comic['url'].split('episode_no=')[1]
+# Per-page messages are only shown in verbose mode, other libraries are left
+# at warning level so httpx does not log every request
+logging.basicConfig(stream=sys.stdout, format='%(message)s')
+log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
 
-    print("Saving issue " + episodeNumber + ": %s_%s..." % (comic['author'], comic['title']))
-
-    # Create output directory
-    os.makedirs(args.output, exist_ok=True)
-    
-    # Raw mode, save images into folders
-    if args.raw:
-        if args.number:
-            outpath = "%s" % args.output + "/" + episodeNumber + "_%s_%s" % (comic['author'], comic['title'])
-        else:
-            outpath = "%s/%s_%s" % (args.output, comic['author'], comic['title'])
-        os.makedirs(outpath, exist_ok=True)
-        
-        # Write each image to folder
-        for index, image in enumerate(comic['page-img']):
-            with open("%s/%s.jpg" % (outpath, index), 'wb') as f:
-                f.write(image)
+log.info("Finding comics...")
+comic_list = process_url_list(args.webtoon_url)
+log.info("Found %i issues.", len(comic_list))
 
-    # CBZ mode
-    else:
-        outpath = "%s/%s_%s.cbz" % (args.output, comic['author'], comic['title'])
-        
-        # Write each image into zip file
-        with zipfile.ZipFile(outpath, 'w') as zip:
-            for index, image in enumerate(comic['page-img']):
-                zip.writestr("%i.jpg" % index, image)
+# Save issues in parallel, each one is written to its own file or folder
+with ThreadPoolExecutor(max_workers=ISSUE_WORKERS) as executor:
+    list(executor.map(lambda comic: save_comic(comic, args), comic_list))
 
-print("Done")
\ No newline at end of file
+log.info("Done")
\ No newline at end of file